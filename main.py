@@ -1,11 +1,21 @@
-from fastapi import FastAPI, File, UploadFile, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, File, UploadFile, Request, WebSocket, HTTPException, Path, Query
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from typing import Annotated
 import os
+import re
+import gzip
+import brotli
+import hashlib
+import orjson
+import time
+import uuid
+import asyncio
 import logging
 from services.stt_service import STTService
-from services.tts_service import TTSService
-from services.llm_service import LLMService
+from services.tts_service import TTSService, TTSJob
+from services.llm_service import LLMService, LLMError
+from services.session_store import SessionStore
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,19 +23,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Config / services
 MURF_API_KEY = os.getenv("MURF_API_KEY")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
 
 stt_service = STTService(ASSEMBLYAI_API_KEY)
 tts_service = TTSService(MURF_API_KEY)
 llm_service = LLMService(GEMINI_API_KEY)
+session_store = SessionStore(REDIS_URL)
+# Keeps publishing tasks referenced until they finish
+tts_publishers = set()
 
 FALLBACK_TEXT = "I'm having trouble connecting right now."
+FALLBACK_AUDIO_TTL = 3600
 CHUNK_SIZE = 3000
+TTS_TARGET_CHARS = 600
+UPLOAD_PART_SIZE = 256 * 1024
+MAX_UPLOAD_PARTS = 256
+UPLOAD_ID_PATTERN = r"^[0-9a-f]{32}$"
+TTS_CONCURRENCY = 3
+SENTENCE_END_RE = re.compile(r"[.!?]\s")
+
+# UI is compressed once at startup rather than on every request
+with open(os.path.join(os.path.dirname(__file__), "static", "index.html"), "rb") as f:
+    UI_HTML = f.read()
+UI_ENCODED = {"br": brotli.compress(UI_HTML, quality=11), "gzip": gzip.compress(UI_HTML, 9)}
+UI_DIGEST = hashlib.blake2b(UI_HTML, digest_size=8).hexdigest()
 
 class ChatRequest(BaseModel):
     session_id: str
@@ -36,482 +63,273 @@ class ChatResponse(BaseModel):
     audioFiles: list[str]
     chat_history: list[dict]
     error: dict | None = None
+    job_id: str | None = None
 
-chat_sessions = {}
+async def warm_fallback_audio():
+    audio_url = await tts_service.synthesize_async(FALLBACK_TEXT)
+    if audio_url:
+        app.state.fallback_audio = [audio_url]
+        app.state.fallback_warmed_at = time.monotonic()
 
-def try_fallback_tts():
-    audio_url = tts_service.synthesize(FALLBACK_TEXT)
-    return [audio_url] if audio_url else []
-
-@app.post("/agent/chat/{session_id}", response_model=ChatResponse)
-async def agent_chat(session_id: str, file: UploadFile = File(...)):
-    try:
-        audio_bytes = await file.read()
-        if not audio_bytes:
-            raise ValueError("No audio bytes received")
-    except Exception as e:
-        logger.error(f"Input error: {e}")
-        return ChatResponse(transcription="", llm_response=FALLBACK_TEXT,
-                            audioFiles=try_fallback_tts(),
-                            chat_history=chat_sessions.get(session_id, []),
-                            error={"stage": "input", "message": str(e)})
+@app.on_event("startup")
+async def startup():
+    app.state.fallback_audio = []
+    app.state.fallback_warmed_at = 0.0
+    app.state.fallback_warmup = asyncio.create_task(warm_fallback_audio())
+    await app.state.fallback_warmup
 
-    user_text = stt_service.transcribe(audio_bytes)
+def try_fallback_tts():
+    # Never synthesizes inline; a missing or aging URL is refreshed in the background
+    stale = (not app.state.fallback_audio
+             or time.monotonic() - app.state.fallback_warmed_at > FALLBACK_AUDIO_TTL)
+    if stale and app.state.fallback_warmup.done():
+        app.state.fallback_warmup = asyncio.create_task(warm_fallback_audio())
+    return list(app.state.fallback_audio)
+
+def chat_event(event_type, **payload):
+    return {"type": event_type, **payload}
+
+def sse_frame(event):
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+async def sse_stream(events):
+    async for event in events:
+        yield sse_frame(event)
+
+async def fallback_event(session_id, stage, message, transcription=""):
+    return chat_event("done", **ChatResponse(
+        transcription=transcription, llm_response=FALLBACK_TEXT,
+        audioFiles=try_fallback_tts(),
+        chat_history=await session_store.get(session_id),
+        error={"stage": stage, "message": message}).model_dump())
+
+async def chat_stream(session_id, user_text):
     if not user_text.strip():
         logger.error("Empty transcription.")
-        return ChatResponse(transcription="", llm_response=FALLBACK_TEXT,
-                            audioFiles=try_fallback_tts(),
-                            chat_history=chat_sessions.get(session_id, []),
-                            error={"stage": "stt", "message": "Empty transcription"})
-
-    session = chat_sessions.setdefault(session_id, [])
-    session.append({"role": "user", "content": user_text})
-
-    dialog = "\n".join(
-        ("User: " if m["role"] == "user" else "AI: ") + m["content"] for m in session
-    ) + "\nAI:"
-    llm_text = llm_service.get_response(dialog)
-    if not llm_text.strip():
-        session.append({"role": "assistant", "content": FALLBACK_TEXT})
-        logger.error("Empty LLM output.")
-        return ChatResponse(transcription=user_text, llm_response=FALLBACK_TEXT,
-                            audioFiles=try_fallback_tts(),
-                            chat_history=session,
-                            error={"stage": "llm", "message": "Empty LLM output"})
+        yield await fallback_event(session_id, "stt", "Empty transcription")
+        return
+    yield chat_event("transcription", text=user_text)
 
-    session.append({"role": "assistant", "content": llm_text})
+    await session_store.append(session_id, {"role": "user", "content": user_text})
+    dialog = await session_store.get_prompt(session_id) + "AI:"
+    tts_job = TTSJob(tts_service, TTS_CONCURRENCY, TTS_TARGET_CHARS, CHUNK_SIZE)
 
-    # TTS
-    audio_urls = []
-    for i in range(0, len(llm_text), CHUNK_SIZE):
-        chunk = llm_text[i:i + CHUNK_SIZE]
-        audio_url = tts_service.synthesize(chunk)
-        if audio_url:
-            audio_urls.append(audio_url)
-    if not audio_urls:
+    parts, pending, llm_error = [], "", None
+    try:
+        async for token in llm_service.stream_response(dialog):
+            parts.append(token)
+            yield chat_event("llm_delta", text=token)
+            pending += token
+            boundary = 0
+            for match in SENTENCE_END_RE.finditer(pending):
+                boundary = match.end()
+            # First sentence goes out alone for fast audio; later ones are batched
+            if boundary and (boundary >= TTS_TARGET_CHARS or not tts_job.tasks):
+                tts_job.dispatch(pending[:boundary])
+                pending = pending[boundary:]
+            for url in tts_job.ready():
+                yield chat_event("audio", url=url)
+    except LLMError as e:
+        llm_error = f"LLM stream failed: {e}"
+    llm_text = "".join(parts)
+    if not llm_text.strip() and not llm_error:
+        llm_error = "Empty LLM output"
+        logger.error("Empty LLM output.")
+    if llm_error:
+        # A truncated reply is neither kept in history nor voiced
+        tts_job.cancel()
+        await session_store.append(session_id, {"role": "assistant", "content": FALLBACK_TEXT})
+        yield await fallback_event(session_id, "llm", llm_error, transcription=user_text)
+        return
+
+    await session_store.append(session_id, {"role": "assistant", "content": llm_text})
+
+    if pending.strip():
+        tts_job.dispatch(pending)
+    for url in tts_job.ready():
+        yield chat_event("audio", url=url)
+
+    # Don't hold the reply open for the rest of the audio; the client follows /tts/{job_id}
+    job_id = None
+    audio_urls = list(tts_job.audio_urls)
+    if not tts_job.finished:
+        job_id = uuid.uuid4().hex
+        await session_store.start_tts(job_id)
+        task = asyncio.create_task(publish_tts_job(job_id, tts_job))
+        tts_publishers.add(task)
+        task.add_done_callback(tts_publishers.discard)
+    elif not audio_urls:
         audio_urls = try_fallback_tts()
 
-    return ChatResponse(
+    yield chat_event("done", **ChatResponse(
         transcription=user_text,
         llm_response=llm_text,
         audioFiles=audio_urls,
-        chat_history=session
-    )
+        chat_history=await session_store.get(session_id),
+        job_id=job_id
+    ).model_dump())
+
+async def publish_tts_job(job_id, job):
+    try:
+        async for url in job.remaining():
+            await session_store.push_tts_url(job_id, url)
+        if not job.audio_urls:
+            for url in try_fallback_tts():
+                await session_store.push_tts_url(job_id, url)
+    except Exception as e:
+        logger.error(f"TTS job error: {e}")
+    finally:
+        await session_store.finish_tts(job_id)
+
+async def tts_job_stream(job_id):
+    audio_urls = []
+    async for url in session_store.tts_urls(job_id):
+        audio_urls.append(url)
+        yield chat_event("audio", url=url)
+    if not audio_urls:
+        yield chat_event("done", audioFiles=try_fallback_tts(),
+                         error={"stage": "tts", "message": "Unknown or failed TTS job"})
+        return
+    yield chat_event("done", audioFiles=audio_urls)
+
+async def audio_chat_response(session_id, audio, size):
+    # Transcribe before streaming starts; the upload is closed once the handler returns
+    user_text = await stt_service.transcribe_async(audio, size)
+    return StreamingResponse(sse_stream(chat_stream(session_id, user_text)),
+                             media_type="text/event-stream")
+
+async def input_error_response(session_id, message):
+    logger.error(f"Input error: {message}")
+    events = iter([sse_frame(await fallback_event(session_id, "input", message))])
+    return StreamingResponse(events, media_type="text/event-stream")
+
+@app.post("/agent/chat/{session_id}")
+async def agent_chat(session_id: str, file: UploadFile = File(...)):
+    if not file.size:
+        return await input_error_response(session_id, "No audio bytes received")
+
+    # Hand the spooled upload to AssemblyAI as a file object instead of reading it into memory
+    return await audio_chat_response(session_id, file.file, file.size)
+
+@app.post("/agent/chat/{session_id}/part/{upload_id}/{index}")
+async def upload_part(session_id: str, upload_id: Annotated[str, Path(pattern=UPLOAD_ID_PATTERN)],
+                      index: int, request: Request):
+    if not 0 <= index < MAX_UPLOAD_PARTS:
+        raise HTTPException(status_code=400, detail="Part index out of range")
+    data = bytearray()
+    async for chunk in request.stream():
+        data.extend(chunk)
+        if len(data) > UPLOAD_PART_SIZE:
+            raise HTTPException(status_code=413, detail="Upload part too large")
+    if not await session_store.add_upload_part(upload_id, index, bytes(data)):
+        raise HTTPException(status_code=503, detail="Upload part not stored")
+    return {"part": index}
+
+@app.post("/agent/chat/{session_id}/complete")
+async def complete_upload(session_id: str, upload_id: Annotated[str, Query(pattern=UPLOAD_ID_PATTERN)],
+                          parts: int):
+    if not 0 < parts <= MAX_UPLOAD_PARTS:
+        return await input_error_response(session_id, "Invalid upload part count")
+    audio_bytes = await session_store.pop_upload(upload_id, parts)
+    if not audio_bytes:
+        return await input_error_response(session_id, "Incomplete or empty audio upload")
+
+    return await audio_chat_response(session_id, audio_bytes, len(audio_bytes))
+
+@app.get("/tts/{job_id}")
+async def tts_audio(job_id: str):
+    return StreamingResponse(sse_stream(tts_job_stream(job_id)),
+                             media_type="text/event-stream")
+
+async def send_event(websocket, event):
+    await websocket.send_text(orjson.dumps(event).decode())
+
+@app.websocket("/ws/{session_id}")
+async def websocket_endpoint(websocket: WebSocket, session_id: str):
+    loop = asyncio.get_running_loop()
+    finals = []
+
+    def on_text(text, final):
+        # Called from the AssemblyAI SDK thread
+        if final:
+            finals.append(text)
+        caption = " ".join(finals if final else finals + [text])
+        asyncio.run_coroutine_threadsafe(
+            send_event(websocket, chat_event("partial", text=caption)), loop)
+
+    # Open realtime STT before the handshake completes, so a refusal reaches the
+    # client as a failed connection and it records for upload instead
+    transcriber = await asyncio.to_thread(stt_service.open_realtime, on_text)
+    if transcriber is None:
+        await websocket.close()
+        return
+    await websocket.accept()
+
+    disconnected, failed = False, False
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                disconnected = True
+                break
+            if message.get("bytes"):
+                transcriber.stream(message["bytes"])
+            elif message.get("text") == "stop":
+                break
+    except Exception as e:
+        logger.error(f"Realtime STT error: {e}")
+        failed = True
+    finally:
+        try:
+            await asyncio.to_thread(transcriber.close)
+        except Exception as e:
+            logger.error(f"Realtime STT error: {e}")
+    if disconnected:
+        return
+    if failed:
+        # The client uploads its backup recording when the socket drops mid-turn
+        await websocket.close(code=1011)
+        return
+
+    async for event in chat_stream(session_id, " ".join(finals)):
+        await send_event(websocket, event)
+    await websocket.close()
+
+def accepted_encodings(header):
+    """Map each Accept-Encoding token to its q-value (q=0 means refused)."""
+    prefs = {}
+    for part in header.split(","):
+        token, *params = part.strip().split(";")
+        if not token.strip():
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        prefs[token.strip().lower()] = q
+    return prefs
+
+def etag_matches(header, etag):
+    """Weak If-None-Match comparison: any listed tag, W/-prefixed or not, or *."""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
 
 @app.get("/", response_class=HTMLResponse)
 async def serve_ui(request: Request):
-    return HTMLResponse("""
-<!DOCTYPE html>
-<html>
-<head>
-<title>🧠 Conversational Agent</title>
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<style>
-  /* Background with subtle floating particles animation */
-  body {
-    margin: 0;
-    width: 100vw;
-    height: 100vh;
-    overflow: hidden;
-    display: flex;
-    align-items: center;
-    justify-content: center;
-    background: #0a0a0a; /* blackish background */
-    position: relative;
-    font-family: 'Segoe UI', Roboto, sans-serif;
-    color: #f5f7ff;
-  }
-  /* Floating Bubble Particles */
-  .bg-particles {
-    position: fixed;
-    top: 0;
-    left: 0;
-    width: 100vw;
-    height: 100vh;
-    pointer-events: none;
-    z-index: 0;
-  }
-  .bg-particles span {
-    position: absolute;
-    display: block;
-    width: 12px;
-    height: 12px;
-    background: radial-gradient(circle, #7b5ae5 40%, transparent 70%);
-    border-radius: 50%;
-    opacity: 0.2;
-    animation: floatUp 20s linear infinite;
-  }
-  @keyframes floatUp {
-    0% {
-      transform: translateY(120vh) translateX(0) scale(1);
-      opacity: 0.2;
-    }
-    50% {
-      opacity: 0.4;
-    }
-    100% {
-      transform: translateY(-20vh) translateX(30vw) scale(1.3);
-      opacity: 0;
-    }
-  }
-
-  /* Container Card */
-  .glass-card {
-    position: relative;
-    z-index: 10;
-    width: 75vw;
-    max-width: 900px;
-    height: 75vh;
-    display: flex;
-    flex-direction: column;
-    box-shadow: 0 8px 32px 0 rgba(34,41,62,0.24);
-    border-radius: 24px;
-    background: rgba(33,35,57,0.97);
-    border: 1.5px solid rgba(110,113,190,0.12);
-    padding: 0;
-    overflow: hidden;
-  }
-  .header {
-    padding: 22px 24px 10px;
-    background: linear-gradient(90deg, #3f68f3 40%, #632bd959 100%);
-    border-radius: 24px 24px 0 0;
-    display: flex;
-    align-items: center;
-    gap: 16px;
-  }
-  .badge {
-    font-size: 19px;
-    font-weight: 600;
-    color: #f5f7ff;
-    letter-spacing: .04em;
-  }
-  .card-body {
-    padding: 32px 38px 28px;
-    flex: 1 1 auto;
-    display: flex;
-    flex-direction: column;
-    position: relative;
-    padding-bottom: 100px; /* space for sticky controls */
-  }
-  .section-title {
-    font-size: 13px;
-    letter-spacing: .06em;
-    color: #d2e0ff;
-    margin-bottom: 12px;
-  }
-  #chat {
-    height: 42vh;            /* fixed, never expands past this */
-    min-height: 220px;       /* ensures small screens aren't too tight */
-    background: rgba(20,24,46,0.92);
-    border-radius: 15px;
-    border: 1px solid #192153;
-    padding: 16px;
-    overflow-y: auto;
-    margin-bottom: 20px;
-    font-size: 16px;
-  }
-  .msg {
-    display: flex;
-    gap: 12px;
-    margin-bottom: 9px;
-  }
-  .msg .avatar {
-    width: 38px;
-    height: 38px;
-    border-radius: 16px;
-    background-size: cover;
-    background-position: center;
-    flex: 0 0 38px;
-    box-shadow: 0 2px 6px rgba(0,0,0,0.06);
-  }
-  .msg.ai .avatar {
-    background-image: url('https://cdn-icons-png.flaticon.com/512/4712/4712023.png');
-  }
-  .msg.user .avatar {
-    background-image: url('https://cdn-icons-png.flaticon.com/512/147/147144.png');
-  }
-  .bubble {
-    max-width: 70%;
-    padding: 14px 18px;
-    background: linear-gradient(120deg,#262e54 70%,#32395a 110%);
-    color: #e5ebff;
-    border-radius: 18px;
-    border: 1px solid #3c436d;
-    font-size: 16px;
-    transition: .18s;
-  }
-  .msg.user .bubble {
-    background: linear-gradient(120deg,#415de6 62%,#7b5ae5 100%);
-    color: #fff;
-    border-radius: 18px 18px 6px 20px;
-  }
-  .msg.ai .bubble {
-    background: linear-gradient(120deg,#232753 70%,#423497 140%);
-    color: #e5eaff;
-    border-radius: 18px 18px 20px 6px;
-  }
-  .status {
-    position: fixed;
-    bottom: 150px;
-    left: 50%;
-    transform: translateX(-50%);
-    background: rgba(33,35,57,0.97);
-    width: 90vw;
-    max-width: 900px;
-    padding: 10px 38px;
-    box-sizing: border-box;
-    z-index: 20;
-    backdrop-filter: blur(8px);
-    border-top: 1px solid rgba(110,113,190,0.12);
-    font-size: 16px;
-    min-height: 24px;
-    color: #63ffde;
-    transition: color 0.5s ease, opacity 0.5s ease;
-  }
-  .status.ready {
-    animation: pulseReady 3s ease infinite;
-  }
-  .status.processing {
-    color: #ffab40;
-    animation: pulseProcessing 1.5s ease infinite;
-  }
-  .status.replying {
-    color: #7b5ae5;
-    animation: pulseReply 2s ease infinite;
-  }
-  @keyframes pulseReady {
-    0%, 100% {opacity: 1;}
-    50% {opacity: 0.6;}
-  }
-  @keyframes pulseProcessing {
-    0%, 100% {opacity: 1;}
-    50% {opacity: 0.3;}
-  }
-  @keyframes pulseReply {
-    0%, 100% {opacity: 1;}
-    50% {opacity: 0.5;}
-  }
-  .controls {
-    position: fixed;
-    bottom: 20px;
-    left: 50%;
-    transform: translateX(-50%);
-    background: rgba(33,35,57,0.97);
-    width: 90vw;
-    max-width: 900px;
-    padding: 10px 38px;
-    box-sizing: border-box;
-    z-index: 20;
-    backdrop-filter: blur(8px);
-    border-top: 1px solid rgba(110,113,190,0.12);
-    display: flex;
-    justify-content: center;
-    margin-bottom: 0;
-  }
-  #recordBtn {
-    font-size: 20px;
-    font-weight: 700;
-    padding: 20px 64px;
-    border-radius: 22px;
-    border: none;
-    outline: none;
-    cursor: pointer;
-    background: linear-gradient(90deg,#5b88fe 80%,#7b5ae5);
-    color: #fff;
-    box-shadow: 0 2px 16px rgba(50,64,227,0.13), 0 0 60px 2px #819cff44;
-    transition: .22s cubic-bezier(.5,2,.5,.6);
-  }
-  #recordBtn.recording {
-    background: linear-gradient(90deg,#7b5ae5 14%,#e34f7a);
-    animation: glowpulse 1.18s infinite;
-    box-shadow: 0 0 42px 12px #7b5ae563, 0 0 4px 0 #d34f9b66;
-  }
-  @keyframes glowpulse {
-    0% { box-shadow: 0 0 15px 6px #e34f7a99; }
-    50% { box-shadow: 0 0 30px 16px #7b5ae5ff; }
-    100% { box-shadow: 0 0 15px 6px #e34f7a99; }
-  }
-  .hint {
-    font-size: 13px;
-    color: #aad3e3;
-    text-align: center;
-    margin-top: 8px;
-  }
-
-  @media (max-width: 768px) {
-    .glass-card {
-      max-width: 100vw;
-      height: 90vh;
-    }
-    .controls, .status {
-      width: 95vw;
-    }
-    #recordBtn {
-      padding: 15px 40px;
-      font-size: 18px;
-    }
-  }
-</style>
-</head>
-<body>
-  <div class="bg-particles" aria-hidden="true"></div>
-  <div class="glass-card" role="main" aria-label="Conversational agent UI">
-    <div class="header">
-      <div class="badge">Conversational Agent 🤖</div>
-    </div>
-    <div class="card-body">
-      <div class="section-title">Conversation</div>
-      <div id="chat" role="log" aria-live="polite" aria-atomic="false"></div>
-      <div id="status" class="status ready" aria-live="polite">Ready to record</div>
-      <div class="controls">
-        <button id="recordBtn" aria-pressed="false" aria-label="Start recording"><span id="micIcon">🎙</span> Start Recording</button>
-      </div>
-      <div class="hint">Tap to record your message, then listen to the AI reply.</div>
-      <audio id="playback" style="display:none"></audio>
-    </div>
-  </div>
-<script>
-  const particleContainer = document.querySelector('.bg-particles');
-  const particleCount = 30; // Number of floating particles
-  
-  for (let i = 0; i < particleCount; i++) {
-    const particle = document.createElement('span');
-    particle.style.left = Math.random() * 100 + 'vw';
-    particle.style.top = Math.random() * 120 + 'vh';
-    particle.style.width = particle.style.height = (6 + Math.random() * 10) + 'px';
-    particle.style.animationDuration = (15 + Math.random() * 10) + 's';
-    particle.style.animationDelay = (Math.random() * -20) + 's';
-    particleContainer.appendChild(particle);
-  }
-  
-  let recorder, chunks = [], isRecording = false,
-      audioContext, analyser, dataArray, rafId, source;
-
-  const chat = document.getElementById("chat");
-  const statusEl = document.getElementById("status");
-  const recordBtn = document.getElementById("recordBtn");
-  const micIcon = document.getElementById("micIcon");
-  const playback = document.getElementById("playback");
-
-  function addMessage(role, txt) {
-    const w = document.createElement("div");
-    w.className = "msg " + (role === "user" ? "user" : "ai");
-    const av = document.createElement("div");
-    av.className = "avatar";
-    const bub = document.createElement("div");
-    bub.className = "bubble";
-    bub.innerText = txt;
-    if (role === "user") {
-      w.appendChild(bub);
-      w.appendChild(av);
-    } else {
-      w.appendChild(av);
-      w.appendChild(bub);
-    }
-    chat.appendChild(w);
-    chat.scrollTop = chat.scrollHeight;
-  }
-
-  function setStatus(txt, emoji = "") {
-    statusEl.textContent = (emoji ? emoji + " " : "") + txt;
-    statusEl.classList.remove("ready", "processing", "replying");
-    if (txt.toLowerCase().includes("ready")) {
-      statusEl.classList.add("ready");
-    } else if (txt.toLowerCase().includes("processing") || txt.toLowerCase().includes("denied")) {
-      statusEl.classList.add("processing");
-    } else if (txt.toLowerCase().includes("playing") || txt.toLowerCase().includes("reply")) {
-      statusEl.classList.add("replying");
-    }
-  }
-
-  recordBtn.addEventListener("click", () => {
-    if (!isRecording) startRecording();
-    else stopRecording();
-  });
-
-  function startRecording() {
-    navigator.mediaDevices.getUserMedia({ audio: true }).then(stream => {
-      recorder = new MediaRecorder(stream);
-      chunks = [];
-      recorder.ondataavailable = e => {
-        if (e.data?.size) chunks.push(e.data);
-      };
-      recorder.onstop = onStop;
-      recorder.start();
-
-      audioContext = new AudioContext();
-      analyser = audioContext.createAnalyser();
-      source = audioContext.createMediaStreamSource(stream);
-      source.connect(analyser);
-      analyser.fftSize = 512;
-      dataArray = new Uint8Array(analyser.frequencyBinCount);
-      animateMicGlow();
-
-      isRecording = true;
-      recordBtn.classList.add("recording");
-      recordBtn.setAttribute("aria-pressed", "true");
-      micIcon.textContent = "⏹";
-      recordBtn.textContent = " Stop Recording";
-      recordBtn.prepend(micIcon);
-      setStatus("Recording…", "🎙");
-    }).catch(() => setStatus("Microphone denied", "❌"));
-  }
-
-  function stopRecording() {
-    if (recorder) recorder.stop();
-    isRecording = false;
-    recordBtn.classList.remove("recording");
-    recordBtn.setAttribute("aria-pressed", "false");
-    micIcon.textContent = "🎙";
-    recordBtn.textContent = " Start Recording";
-    recordBtn.prepend(micIcon);
-    cancelAnimationFrame(rafId);
-    if (audioContext) audioContext.close();
-    setStatus("Processing…", "⏳");
-  }
-
-  function animateMicGlow() {
-    analyser.getByteFrequencyData(dataArray);
-    let volume = dataArray.reduce((a, b) => a + b) / dataArray.length;
-    let intensity = Math.min(volume / 255, 1);
-    recordBtn.style.boxShadow = `0 0 ${10 + intensity * 34}px ${
-      4 + intensity * 8
-    }px rgba(123,90,229,${0.29 + intensity / 1.8})`;
-    rafId = requestAnimationFrame(animateMicGlow);
-  }
-
-  async function onStop() {
-    const blob = new Blob(chunks, { type: "audio/webm;codecs=opus" });
-    const form = new FormData();
-    form.append("file", blob, "query.webm");
-    try {
-      const res = await fetch("/agent/chat/session1", { method: "POST", body: form });
-      const data = await res.json();
-
-      if (data?.transcription) addMessage("user", data.transcription);
-      if (data?.llm_response) addMessage("ai", data.llm_response);
-
-      if (Array.isArray(data?.audioFiles) && data.audioFiles.length) {
-        playback.src = data.audioFiles[0];
-        playback.play();
-        setStatus("Audio reply playing…", "✅");
-      } else {
-        setStatus("No audio returned", "⚠️");
-      }
-      if (data?.error?.stage) {
-        setStatus(`Error: ${data.error.stage}`, "⚠️");
-      }
-    } catch (error) {
-      setStatus("Server error: " + error.message, "❌");
-    } finally {
-      chunks = [];
-    }
-  }
-
-  playback.addEventListener("ended", () => {
-    setStatus("Ready to record", "🎙");
-  });
-</script>
-</body>
-</html>
-""")
\ No newline at end of file
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    wildcard = accepted.get("*", 0.0)
+    acceptable = [e for e in UI_ENCODED if accepted.get(e, wildcard) > 0]
+    # Highest q wins; ties keep UI_ENCODED order, so brotli is preferred
+    encoding = max(acceptable, key=lambda e: accepted.get(e, wildcard), default=None)
+    body = UI_ENCODED[encoding] if encoding else UI_HTML
+    etag = f'"{UI_DIGEST}-{encoding}"' if encoding else f'"{UI_DIGEST}"'
+    headers = {"Cache-Control": "public, max-age=3600", "ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="text/html", headers=headers)
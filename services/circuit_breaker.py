@@ -0,0 +1,21 @@
+from collections import deque
+import time
+
+class CircuitBreaker:
+    """Opens for `cooldown` seconds once `threshold` of the last `window` calls failed."""
+
+    def __init__(self, window=10, threshold=7, cooldown=30.0):
+        self.results = deque(maxlen=window)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.open_until = 0.0
+
+    @property
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record(self, ok):
+        self.results.append(ok)
+        if self.results.count(False) >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            self.results.clear()
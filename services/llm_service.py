@@ -1,19 +1,62 @@
+from cachetools import TTLCache
 import google.genai
+import asyncio
+import hashlib
 import logging
+from services.circuit_breaker import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
+class LLMError(Exception):
+    """The LLM call failed; any text already yielded is incomplete."""
+
 class LLMService:
-    def __init__(self, api_key):
+    def __init__(self, api_key, cache_size=512, cache_ttl=3600, timeout=10.0):
         self.client = google.genai.Client(api_key=api_key) if api_key else None
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Applies to the first response and to every gap between streamed chunks
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
 
-    def get_response(self, dialog):
+    async def stream_response(self, dialog):
+        key = hashlib.blake2b(dialog.encode(), digest_size=16).hexdigest()
+        if key in self.cache:
+            logger.info("LLM response served from cache.")
+            yield self.cache[key]
+            return
+        if self.breaker.is_open:
+            logger.error("LLM circuit open; skipping call.")
+            raise LLMError("circuit open")
+        parts = []
+        stream = None
         try:
-            resp = self.client.models.generate_content(
+            stream = await asyncio.wait_for(self.client.aio.models.generate_content_stream(
                 model="gemini-2.5-flash", contents=dialog
-            )
-            logger.info("LLM response generated.")
-            return resp.text or ""
+            ), self.timeout)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), self.timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            logger.info("LLM response streamed.")
+        except asyncio.TimeoutError as e:
+            logger.error("LLM error: timed out")
+            self.breaker.record(False)
+            raise LLMError("timed out") from e
         except Exception as e:
             logger.error(f"LLM error: {e}")
-            return ""
+            self.breaker.record(False)
+            raise LLMError(str(e)) from e
+        finally:
+            # Release the upstream connection if we stopped reading early
+            if stream is not None:
+                try:
+                    await stream.aclose()
+                except Exception:
+                    pass
+        self.breaker.record(True)
+        if "".join(parts).strip():
+            self.cache[key] = "".join(parts)
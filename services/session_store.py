@@ -0,0 +1,200 @@
+from cachetools import TTLCache
+import redis.asyncio as redis
+from redis.exceptions import WatchError
+import json
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+SPEAKER_PREFIX = {"user": "User: "}
+
+def render_message(message):
+    # Rendered once per message on append; turns only ever concatenate these
+    return SPEAKER_PREFIX.get(message["role"], "AI: ") + message["content"] + "\n"
+
+class SessionStore:
+    def __init__(self, redis_url=None, cache_size=1024, cache_ttl=300, upload_ttl=300,
+                 session_ttl=7 * 24 * 3600, tts_ttl=600):
+        self.redis = redis.from_url(redis_url) if redis_url else None
+        # Hot sessions, refreshed incrementally from Redis; without Redis this is the only copy
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if self.redis else {}
+        self.upload_ttl = upload_ttl
+        # Idle sessions expire from Redis; every append pushes the deadline back
+        self.session_ttl = session_ttl
+        self.uploads = TTLCache(maxsize=256, ttl=upload_ttl)
+        self.tts_ttl = tts_ttl
+        self.tts_jobs = TTLCache(maxsize=1024, ttl=tts_ttl)
+
+    @staticmethod
+    def _key(session_id):
+        return f"sess:{session_id}"
+
+    @staticmethod
+    def _new_session():
+        # The prompt is appended to turn by turn instead of re-joined from every message
+        return {"messages": [], "prompt": bytearray()}
+
+    async def _load(self, session_id):
+        if self.redis is None:
+            return self.cache.get(session_id) or self._new_session()
+        # Another worker may have appended since we cached this session, so always
+        # fetch the tail past what we hold; a fresh cache entry costs one empty read
+        key = self._key(session_id)
+        cached = self.cache.get(session_id)
+        start, offset = (len(cached["messages"]), len(cached["prompt"])) if cached else (0, 0)
+        try:
+            async with self.redis.pipeline() as pipe:
+                raw, prompt = await pipe.lrange(key, start, -1).getrange(f"{key}:prompt", offset, -1).execute()
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+            return cached or self._new_session()
+        messages = [json.loads(m) for m in raw]
+        if cached:
+            if len(cached["messages"]) == start:  # a concurrent read may have caught up already
+                cached["messages"].extend(messages)
+                cached["prompt"].extend(prompt)
+            return cached
+        rendered = "".join(render_message(m) for m in messages).encode()
+        if prompt != rendered:
+            # Legacy history without a prompt key, or a key an APPEND started mid-dialog
+            logger.warning(f"Rebuilding prompt for session {session_id}.")
+            try:
+                messages, prompt = await self._rebuild_prompt(key)
+            except Exception as e:
+                logger.error(f"Session store error: {e}")
+                return {"messages": messages, "prompt": bytearray(rendered)}
+        session = {"messages": messages, "prompt": bytearray(prompt)}
+        self.cache[session_id] = session
+        return session
+
+    async def _rebuild_prompt(self, key):
+        # WATCH both keys so a concurrent append makes us re-render instead of being overwritten
+        async with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(key, f"{key}:prompt")
+                    messages = [json.loads(m) for m in await pipe.lrange(key, 0, -1)]
+                    prompt = "".join(render_message(m) for m in messages).encode()
+                    pipe.multi()
+                    pipe.set(f"{key}:prompt", prompt, ex=self.session_ttl)
+                    await pipe.execute()
+                    return messages, prompt
+                except WatchError:
+                    continue
+
+    async def get(self, session_id):
+        return (await self._load(session_id))["messages"]
+
+    async def get_prompt(self, session_id):
+        return (await self._load(session_id))["prompt"].decode()
+
+    async def append(self, session_id, message):
+        rendered = render_message(message).encode()
+        if self.redis is None:
+            session = self.cache.setdefault(session_id, self._new_session())
+            session["messages"].append(message)
+            session["prompt"].extend(rendered)
+            return
+        # MULTI/EXEC keeps history and prompt in step; the cache picks both up on the next read
+        key = self._key(session_id)
+        try:
+            async with self.redis.pipeline() as pipe:
+                length, prompt_length, *_ = await (
+                    pipe.rpush(key, json.dumps(message)).append(f"{key}:prompt", rendered)
+                    .expire(key, self.session_ttl).expire(f"{key}:prompt", self.session_ttl)
+                    .execute())
+            if length > 1 and prompt_length == len(rendered):
+                # The prompt key was missing, so APPEND started it without the earlier turns
+                await self._rebuild_prompt(key)
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+
+    async def add_upload_part(self, upload_id, index, data):
+        if self.redis is None:
+            self.uploads.setdefault(upload_id, {})[index] = data
+            return True
+        key = f"upload:{upload_id}"
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                await pipe.hset(key, index, data).expire(key, self.upload_ttl).execute()
+            return True
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+            return False
+
+    async def pop_upload(self, upload_id, part_count):
+        if self.redis is None:
+            parts = self.uploads.pop(upload_id, {})
+        else:
+            key = f"upload:{upload_id}"
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    raw, _ = await pipe.hgetall(key).delete(key).execute()
+            except Exception as e:
+                logger.error(f"Session store error: {e}")
+                return None
+            parts = {int(i): data for i, data in raw.items()}
+        if any(i not in parts for i in range(part_count)):
+            return None
+        return b"".join(parts[i] for i in range(part_count))
+
+    # TTS jobs: the worker running a job publishes its audio URLs in order under
+    # tts:{job_id}, and tts:{job_id}:state goes pending -> done, so any worker can serve them
+
+    async def start_tts(self, job_id):
+        if self.redis is None:
+            self.tts_jobs[job_id] = {"urls": [], "state": "pending"}
+            return
+        try:
+            await self.redis.set(f"tts:{job_id}:state", "pending", ex=self.tts_ttl)
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+
+    async def push_tts_url(self, job_id, url):
+        if self.redis is None:
+            if job_id in self.tts_jobs:
+                self.tts_jobs[job_id]["urls"].append(url)
+            return
+        key = f"tts:{job_id}"
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                await pipe.rpush(key, url).expire(key, self.tts_ttl).execute()
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+
+    async def finish_tts(self, job_id):
+        if self.redis is None:
+            if job_id in self.tts_jobs:
+                self.tts_jobs[job_id]["state"] = "done"
+            return
+        try:
+            await self.redis.set(f"tts:{job_id}:state", "done", ex=self.tts_ttl)
+        except Exception as e:
+            logger.error(f"Session store error: {e}")
+
+    async def _read_tts(self, job_id, cursor):
+        if self.redis is None:
+            job = self.tts_jobs.get(job_id)
+            return (job["urls"][cursor:], job["state"]) if job else ([], None)
+        key = f"tts:{job_id}"
+        async with self.redis.pipeline() as pipe:
+            urls, state = await pipe.lrange(key, cursor, -1).get(f"{key}:state").execute()
+        return [u.decode() for u in urls], state.decode() if state else None
+
+    async def tts_urls(self, job_id, poll_interval=0.2, timeout=120.0):
+        # Ends when the job is done, unknown or expired, or after timeout
+        cursor, deadline = 0, time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                urls, state = await self._read_tts(job_id, cursor)
+            except Exception as e:
+                logger.error(f"Session store error: {e}")
+                return
+            for url in urls:
+                yield url
+            cursor += len(urls)
+            if state != "pending":
+                return
+            await asyncio.sleep(poll_interval)
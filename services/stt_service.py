@@ -1,18 +1,66 @@
 import assemblyai as aai
+import asyncio
 import logging
+import time
+from services.circuit_breaker import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
 class STTService:
-    def __init__(self, api_key):
+    def __init__(self, api_key, timeout=30.0, timeout_per_mb=15.0, poll_interval=1.0):
         aai.settings.api_key = api_key
+        aai.settings.http_timeout = 10.0
+        self.transcriber = aai.Transcriber()
+        # Budget for upload plus polling, stretched for longer recordings. We poll
+        # ourselves so no worker thread keeps waiting once the budget is spent.
+        self.timeout = timeout
+        self.timeout_per_mb = timeout_per_mb
+        self.poll_interval = poll_interval
+        self.breaker = CircuitBreaker()
 
-    def transcribe(self, audio_bytes):
+    async def _transcribe(self, audio, deadline):
+        # audio may be raw bytes or a binary file object; the SDK streams the latter.
+        # Submitting (upload plus create) and each poll are plain HTTP calls capped by http_timeout.
+        transcript = await asyncio.wait_for(
+            asyncio.to_thread(self.transcriber.submit, audio), deadline - time.monotonic())
+        while transcript.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("timed out")
+            await asyncio.sleep(min(self.poll_interval, remaining))
+            transcript = await asyncio.to_thread(aai.Transcript.get_by_id, transcript.id)
+        if transcript.status == aai.TranscriptStatus.error:
+            raise RuntimeError(transcript.error)
+        return transcript.text or ""
+
+    async def transcribe_async(self, audio, size=0):
+        if self.breaker.is_open:
+            logger.error("STT circuit open; skipping call.")
+            return ""
+        deadline = time.monotonic() + self.timeout + self.timeout_per_mb * size / 2**20
         try:
-            transcriber = aai.Transcriber()
-            transcript = transcriber.transcribe(audio_bytes)
+            text = await self._transcribe(audio, deadline)
             logger.info("Transcription complete.")
-            return transcript.text or ""
+            ok = True
+        except Exception as e:
+            logger.error(f"STT error: {e or 'timed out'}")
+            text, ok = "", False
+        self.breaker.record(ok)
+        return text
+
+    def open_realtime(self, on_text, sample_rate=16000):
+        def on_data(transcript):
+            if transcript.text:
+                on_text(transcript.text, isinstance(transcript, aai.RealtimeFinalTranscript))
+
+        try:
+            transcriber = aai.RealtimeTranscriber(
+                sample_rate=sample_rate, on_data=on_data,
+                on_error=lambda e: logger.error(f"Realtime STT error: {e}")
+            )
+            transcriber.connect()
+            logger.info("Realtime transcription session opened.")
+            return transcriber
         except Exception as e:
             logger.error(f"STT error: {e}")
-            return ""
+            return None
@@ -1,22 +1,120 @@
+from cachetools import TTLCache
 from murf import Murf
+import re
+import asyncio
+import httpx
 import logging
+import threading
+from services.circuit_breaker import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
+SENTENCE_BOUNDARY_RE = re.compile(r"(?<=[.!?])\s+")
+
+def split_sentences(text, target=600, limit=3000):
+    # Merge whole sentences up to ~target chars; only a single overlong sentence is cut at limit
+    chunks, current = [], ""
+    for sentence in SENTENCE_BOUNDARY_RE.split(text.strip()):
+        if current and len(current) + len(sentence) + 1 > target:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return [c[i:i + limit] for c in chunks for i in range(0, len(c), limit)]
+
 class TTSService:
-    def __init__(self, api_key, default_voice="en-US-natalie"):
-        self.client = Murf(api_key=api_key) if api_key else None
+    def __init__(self, api_key, default_voice="en-US-natalie", cache_size=1024, cache_ttl=3600,
+                 timeout=8.0):
+        # One pooled HTTP/2 client for every synthesis thread
+        http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+        self.client = Murf(api_key=api_key, httpx_client=http_client) if api_key else None
         self.default_voice = default_voice
+        # synthesize() runs in worker threads via synthesize_async
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.cache_lock = threading.Lock()
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
 
     def synthesize(self, text, voice_id=None):
         voice_id = voice_id or self.default_voice
+        key = (text, voice_id)
+        with self.cache_lock:
+            cached = self.cache.get(key)
+        if cached:
+            logger.info("TTS audio served from cache.")
+            return cached
+        if self.breaker.is_open:
+            logger.error("TTS circuit open; skipping call.")
+            return None
         try:
             res = self.client.text_to_speech.generate(
                 text=text, voice_id=voice_id,
-                format="MP3", sample_rate=44100.0
+                format="MP3", sample_rate=44100.0,
+                request_options={"timeout_in_seconds": self.timeout}
             )
             logger.info("TTS synthesis complete.")
-            return res.audio_file
         except Exception as e:
             logger.error(f"TTS error: {e}")
+            self.breaker.record(False)
             return None
+        self.breaker.record(True)
+        if res.audio_file:
+            with self.cache_lock:
+                self.cache[key] = res.audio_file
+        return res.audio_file
+
+    async def synthesize_async(self, text, voice_id=None):
+        return await asyncio.to_thread(self.synthesize, text, voice_id)
+
+class TTSJob:
+    """Ordered, bounded-concurrency synthesis of a reply that arrives in pieces."""
+
+    def __init__(self, tts_service, concurrency=3, target=600, limit=3000):
+        self.tts_service = tts_service
+        self.sem = asyncio.Semaphore(concurrency)
+        self.target = target
+        self.limit = limit
+        self.tasks = []
+        self.audio_urls = []
+        self.collected = 0
+
+    async def _synthesize(self, chunk):
+        async with self.sem:
+            return await self.tts_service.synthesize_async(chunk)
+
+    def dispatch(self, text):
+        for chunk in split_sentences(text, self.target, self.limit):
+            self.tasks.append(asyncio.create_task(self._synthesize(chunk)))
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    @property
+    def finished(self):
+        return self.collected == len(self.tasks)
+
+    def _collect(self):
+        url = self.tasks[self.collected].result()
+        self.collected += 1
+        if url:
+            self.audio_urls.append(url)
+        return url
+
+    def ready(self):
+        # Finished audio in submission order, never skipping ahead
+        urls = []
+        while not self.finished and self.tasks[self.collected].done():
+            urls.append(self._collect())
+        return [url for url in urls if url]
+
+    async def remaining(self):
+        while not self.finished:
+            await self.tasks[self.collected]
+            url = self._collect()
+            if url:
+                yield url